@@ -1,25 +1,45 @@
+import hashlib
+import io
+import json
 import os
+import sys
 import time
 import random
 import threading
 import requests
 import re
-from datetime import datetime, timedelta
-import pytz
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from urllib.parse import quote
+import atexit
+import logging
+import logging.handlers
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import dotenv_values
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
+# Heavier Google client modules (discovery, oauthlib flow, httplib2 transport) are imported
+# inside the functions that need them so the web UI starts without loading them.
 from googleapiclient.errors import HttpError
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.exceptions import RefreshError, TransportError
+try:
+    import orjson  # optional; faster decoding of SDUI timetables and token.json
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'
 
 # --- GLOBALS ---
-LOG_BUFFER = []
-ABORT_FLAG = False
-IS_RUNNING = False
+LOG_BUFFER = deque(maxlen=500)  # (seq, entry) pairs
+LOG_SEQ = 0
+LOG_COND = threading.Condition()  # notified on every new log entry
+_JOB_LOCKS = {}  # calendar id -> Lock held while a job runs against that calendar
+_ABORT_EVENTS = {}  # calendar id -> Event set by /stop
 
 # Global Config Variables
 SDUI_USER_ID = None
@@ -28,23 +48,49 @@ SDUI_EMAIL = None
 SDUI_PASSWORD = None
 SDUI_SCHOOL_ID = None
 TIMEZONE = None
+TZ = None  # ZoneInfo for TIMEZONE, rebuilt by load_config()
 GOOGLE_CALENDAR_ID = None
+_ENV = {}  # Parsed .env contents, refreshed by load_config()
+
+SDUI_TIMETABLE_URL = 'https://api.sdui.app/v1/timetables/users/{uid}/timetable'
+SDUI_FETCH_WORKERS = 8  # concurrent week requests for long ranges
+
+# Pooled keep-alive connections for api.sdui.app (avoids a TLS handshake per call)
+SDUI_SESSION = requests.Session()
+SDUI_SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+SDUI_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+))
+
+# Console output is formatted and written on a listener thread so workers never block on stdout
+_LOG_QUEUE = queue.Queue(-1)
+logger = logging.getLogger('sdui')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(_LOG_QUEUE))
+LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler(sys.stdout))
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 
 def log_msg(message):
+    global LOG_SEQ
     timestamp = datetime.now().strftime("%H:%M:%S")
     entry = f"[{timestamp}] {message}"
-    print(entry)
-    LOG_BUFFER.append(entry)
-    if len(LOG_BUFFER) > 500:
-        LOG_BUFFER.pop(0)
+    logger.info(entry)
+    with LOG_COND:
+        LOG_SEQ += 1
+        LOG_BUFFER.append((LOG_SEQ, entry))
+        LOG_COND.notify_all()
 
 # --- CONFIG MANAGEMENT ---
 
 def repair_env_file():
-    """Fixes corrupted .env files where lines merged (e.g. Berlin'SYNC_YEAR)."""
-    if not os.path.exists('.env'): return
+    """Fixes corrupted .env files where lines merged (e.g. Berlin'SYNC_YEAR).
+    Returns the repaired contents so callers don't need to read the file again (None if missing)."""
+    if not os.path.exists('.env'): return None
 
-    with open('.env', 'r') as f:
+    with open('.env', 'r', encoding='utf-8') as f:
         content = f.read()
 
     # Regex to find merged keys (e.g. 'VALUE'NEXT_KEY=)
@@ -57,64 +103,59 @@ def repair_env_file():
 
     if content != fixed_content:
         print(">>> DETECTED CORRUPTED .ENV FILE. REPAIRING... <<<")
-        with open('.env', 'w') as f:
+        with open('.env', 'w', encoding='utf-8') as f:
             f.write(fixed_content)
+    return fixed_content
+
+def load_env_file(content):
+    """Parses .env contents into the in-memory _ENV cache."""
+    global _ENV
+    _ENV = dict(dotenv_values(stream=io.StringIO(content), interpolate=False)) if content is not None else {}
 
 def read_env_key(key, default=None):
-    try:
-        if os.path.exists('.env'):
-            with open('.env', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if not line or line.startswith('#'): continue
-                    if '=' in line:
-                        k, v = line.split('=', 1)
-                        if k.strip() == key: return v.strip().strip('"').strip("'")
-    except: pass
-    return os.environ.get(key, default)
+    return _ENV.get(key) or os.environ.get(key, default)
 
 def update_env_file(updates):
-    """Updates multiple keys in the .env file safely."""
+    """Rewrites the updated KEY= lines of .env in one pass, keeping comments and other lines intact."""
+    pending = {}
+    for key, value in updates.items():
+        _ENV[key] = str(value) if value is not None else ""
+        val_str = _ENV[key].replace('\\', '\\\\').replace("'", "\\'")
+        pending[key] = f"{key}='{val_str}'\n"
+
     lines = []
     if os.path.exists('.env'):
-        with open('.env', 'r') as f:
+        with open('.env', 'r', encoding='utf-8') as f:
             lines = f.readlines()
-    
-    # Process updates
-    for key, value in updates.items():
-        found = False
-        new_lines = []
-        for line in lines:
-            if line.strip().startswith(f"{key}="):
-                val_str = str(value) if value is not None else ""
-                new_lines.append(f"{key}='{val_str}'\n")
-                found = True
-            else:
-                new_lines.append(line)
-        
-        if not found:
-            # Ensure previous line has newline
-            if new_lines and not new_lines[-1].endswith('\n'):
-                new_lines[-1] += '\n'
-            
-            val_str = str(value) if value is not None else ""
-            new_lines.append(f"{key}='{val_str}'\n")
-            
-        lines = new_lines
 
-    with open('.env', 'w') as f:
+    found = set()
+    for i, line in enumerate(lines):
+        key = line.strip().partition('=')[0]
+        if '=' in line and key in pending:
+            lines[i] = pending[key]
+            found.add(key)
+
+    if lines and not lines[-1].endswith('\n'): lines[-1] += '\n'
+    lines.extend(line for key, line in pending.items() if key not in found)
+
+    with open('.env', 'w', encoding='utf-8') as f:
         f.writelines(lines)
 
 def load_config():
     """Reloads global config variables from .env"""
-    global SDUI_USER_ID, SDUI_AUTH_TOKEN, TIMEZONE, GOOGLE_CALENDAR_ID
+    global SDUI_USER_ID, SDUI_AUTH_TOKEN, TIMEZONE, TZ, GOOGLE_CALENDAR_ID
     global SDUI_EMAIL, SDUI_PASSWORD, SDUI_SCHOOL_ID
     
-    repair_env_file() # Fix file before reading
+    load_env_file(repair_env_file()) # Fix file before reading
     
     SDUI_USER_ID = read_env_key('SDUI_USER_ID')
     SDUI_AUTH_TOKEN = read_env_key('SDUI_AUTH_TOKEN')
     TIMEZONE = read_env_key('TIMEZONE', 'Europe/Berlin')
+    try:
+        TZ = ZoneInfo(TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError) as e:  # a typo in .env must not stop the app from starting
+        log_msg(f"Invalid TIMEZONE '{TIMEZONE}' ({e}). Falling back to Europe/Berlin.")
+        TIMEZONE, TZ = 'Europe/Berlin', ZoneInfo('Europe/Berlin')
     GOOGLE_CALENDAR_ID = read_env_key('GOOGLE_CALENDAR_ID', 'primary')
     SDUI_EMAIL = read_env_key('SDUI_EMAIL')
     SDUI_PASSWORD = read_env_key('SDUI_PASSWORD')
@@ -126,29 +167,110 @@ SCOPES = ['https://www.googleapis.com/auth/calendar']
 TOKEN_FILE = 'auth/token.json'
 CREDENTIALS_FILE = 'auth/credentials.json'
 
+_CREDS_CACHE = {}  # identity key -> Credentials, so a second Google identity can't clobber the first
+_CREDS_KEY = hashlib.sha256(f"{CREDENTIALS_FILE}|{TOKEN_FILE}".encode()).hexdigest()
+_CREDS_LOCK = threading.Lock()
+_LAST_TOKEN_JSON = None  # last token JSON read from or written to TOKEN_FILE
+REFRESH_RETRIES = 3
+TOKEN_REFRESH_MARGIN = 300  # seconds of validity a cached token must have left to be reused
+
 # --- HELPERS ---
+def refresh_credentials(creds):
+    """Refreshes an access token, retrying transient network errors with backoff.
+    Returns None if the refresh token was rejected or the network never recovered."""
+    from google.auth.transport.requests import Request
+
+    for attempt in range(REFRESH_RETRIES):
+        try:
+            creds.refresh(Request())
+            return creds
+        except RefreshError as e:
+            log_msg(f"Token refresh rejected: {e}")
+            return None
+        except TransportError as e:
+            if attempt == REFRESH_RETRIES - 1:
+                log_msg(f"Token refresh network error: {e}.")
+                break
+            wait = 2 ** attempt
+            log_msg(f"Token refresh network error: {e}. Retrying in {wait}s...")
+            time.sleep(wait)
+    log_msg(f"Token refresh failed after {REFRESH_RETRIES} attempts.")
+    return None
+
+def save_token(creds):
+    """Persists credentials atomically, skipping the write when nothing changed."""
+    global _LAST_TOKEN_JSON
+    token_json = creds.to_json()
+    if token_json == _LAST_TOKEN_JSON: return
+
+    os.makedirs(os.path.dirname(TOKEN_FILE), exist_ok=True)
+    tmp = TOKEN_FILE + '.tmp'
+    with open(tmp, 'w') as token: token.write(token_json)
+    os.replace(tmp, TOKEN_FILE)
+    _LAST_TOKEN_JSON = token_json
+
+def token_seconds_left(creds):
+    """Seconds until the access token expires (google-auth stores expiry as naive UTC)."""
+    if not creds.expiry: return float('inf')
+    return (creds.expiry.replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+
+def get_credentials():
+    """Returns Google credentials, cached in memory for the process lifetime."""
+    global _LAST_TOKEN_JSON
+    creds = _CREDS_CACHE.get(_CREDS_KEY)
+    if creds and creds.valid and token_seconds_left(creds) > TOKEN_REFRESH_MARGIN:
+        return creds  # fast path: no lock, no disk
+
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    with _CREDS_LOCK:
+        creds = _CREDS_CACHE.get(_CREDS_KEY)
+        if creds is None and os.path.exists(TOKEN_FILE):
+            try:
+                with open(TOKEN_FILE, 'rb') as f:
+                    creds = Credentials.from_authorized_user_info(json_loads(f.read()), SCOPES)
+                _LAST_TOKEN_JSON = creds.to_json()
+            except (ValueError, OSError) as e: log_msg(f"Ignoring unreadable {TOKEN_FILE}: {e}")
+
+        if creds and creds.valid and creds.refresh_token and token_seconds_left(creds) <= TOKEN_REFRESH_MARGIN:
+            # Refresh ahead of expiry so a long job doesn't hit it; keep the current token if that fails
+            if refresh_credentials(creds): save_token(creds)
+
+        if not creds or not creds.valid:
+            if creds and creds.refresh_token:
+                creds = refresh_credentials(creds)
+            else:
+                creds = None
+
+            if not creds:
+                if read_env_key('SDUI_HEADLESS', '0') == '1':
+                    # No browser on this machine: run_local_server would block the worker forever
+                    log_msg(f"ERROR: Google token missing or revoked. Run app.py locally to generate {TOKEN_FILE}, then redeploy it.")
+                    return None
+                if not os.path.exists(CREDENTIALS_FILE):
+                    log_msg(f"ERROR: {CREDENTIALS_FILE} missing.")
+                    return None
+                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+                creds = flow.run_local_server(port=0)
+
+            save_token(creds)
+
+        _CREDS_CACHE[_CREDS_KEY] = creds
+        return creds
+
 def get_calendar_service():
-    creds = None
-    if os.path.exists(TOKEN_FILE):
-        try: creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-        except: pass
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try: creds.refresh(Request())
-            except: creds = None
-
-        if not creds:
-            if not os.path.exists(CREDENTIALS_FILE):
-                log_msg(f"ERROR: {CREDENTIALS_FILE} missing.")
-                return None
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        if not os.path.exists('auth'): os.makedirs('auth')
-        with open(TOKEN_FILE, 'w') as token: token.write(creds.to_json())
-            
-    return build('calendar', 'v3', credentials=creds)
+    """Builds a calendar client for one job. Only the credentials are cached: each client gets its
+    own httplib2.Http because httplib2 isn't thread-safe and jobs on different calendars can overlap."""
+    creds = get_credentials()
+    if not creds: return None
+
+    import httplib2
+    from googleapiclient.discovery import build
+    from google_auth_httplib2 import AuthorizedHttp
+
+    # static_discovery uses the discovery doc bundled with google-api-python-client
+    return build('calendar', 'v3', http=AuthorizedHttp(creds, http=httplib2.Http()), static_discovery=True)
 
 def resolve_school_id(uuid_or_id):
     if not uuid_or_id: return None
@@ -158,7 +280,7 @@ def resolve_school_id(uuid_or_id):
     log_msg(f"Resolving School UUID: {uuid_or_id}...")
     url = f"https://api.sdui.app/v1/schools/{uuid_or_id}"
     try:
-        resp = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
+        resp = SDUI_SESSION.get(url, timeout=30)
         if resp.status_code == 200:
             data = resp.json().get('data', {})
             int_id = data.get('id')
@@ -190,11 +312,9 @@ def auto_login():
         "school_id": school_id_int
     }
     
-    headers = {"Content-Type": "application/json", "User-Agent": "Mozilla/5.0"}
-
     try:
         log_msg(f"Attempting auto-login for {email}...")
-        resp = requests.post(url, json=payload, headers=headers)
+        resp = SDUI_SESSION.post(url, json=payload, timeout=30)
         
         if resp.status_code == 200:
             data = resp.json()
@@ -219,7 +339,44 @@ def auto_login():
     
     return None
 
+def week_ranges(start_date, end_date):
+    """Splits an inclusive date range into consecutive chunks of at most 7 days."""
+    ranges = []
+    current = start_date
+    while current <= end_date:
+        chunk_end = min(current + timedelta(days=6), end_date)
+        ranges.append((current, chunk_end))
+        current = chunk_end + timedelta(days=1)
+    return ranges
+
+def fetch_sdui_range(start_date, end_date):
+    headers = {'Authorization': f'Bearer {SDUI_AUTH_TOKEN}'}
+    params = {'begins_at': start_date.isoformat(), 'ends_at': end_date.isoformat()}  # dates -> YYYY-MM-DD
+    url = SDUI_TIMETABLE_URL.format(uid=quote(str(SDUI_USER_ID), safe=''))
+
+    r = SDUI_SESSION.get(url, params=params, headers=headers, timeout=30)
+    r.raise_for_status()
+    return json_loads(r.content)
+
+def fetch_sdui_weeks(weeks):
+    """Fetches each week concurrently over the pooled session and merges the lessons."""
+    if len(weeks) == 1: return fetch_sdui_range(*weeks[0])
+
+    with ThreadPoolExecutor(max_workers=min(SDUI_FETCH_WORKERS, len(weeks))) as ex:
+        results = list(ex.map(lambda week: fetch_sdui_range(*week), weeks))
+
+    merged = results[0]
+    merged.setdefault('data', {})['lessons'] = [
+        lesson for result in results
+        for lesson in ((result.get('data') or {}).get('lessons') or [])
+    ]
+    return merged
+
 def get_sdui_data(start_date, end_date):
+    if start_date > end_date:
+        log_msg(f"Error: Invalid range {start_date} -> {end_date} (end before start).")
+        return None
+
     if not SDUI_AUTH_TOKEN:
         log_msg("Token missing. Attempting login...")
         auto_login()
@@ -229,118 +386,217 @@ def get_sdui_data(start_date, end_date):
         return None
     
     log_msg(f"Fetching SDUI: {start_date} -> {end_date}")
-    headers = {'Authorization': f'Bearer {SDUI_AUTH_TOKEN}', 'User-Agent': 'Mozilla/5.0'}
-    begins_at = start_date.strftime("%Y-%m-%d")
-    ends_at = end_date.strftime("%Y-%m-%d")
-    url = f"https://api.sdui.app/v1/timetables/users/{SDUI_USER_ID}/timetable?begins_at={begins_at}&ends_at={ends_at}"
+    weeks = week_ranges(start_date, end_date)
     
     try:
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
-        return r.json()
+        return fetch_sdui_weeks(weeks)
     except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 401:
+        response = getattr(e, 'response', None)
+        if response is not None and response.status_code == 401:
             log_msg("Token expired (401). Refreshing...")
             if auto_login():
-                headers['Authorization'] = f'Bearer {SDUI_AUTH_TOKEN}'
-                try:
-                    r = requests.get(url, headers=headers)
-                    r.raise_for_status()
-                    return r.json()
-                except: pass
+                try: return fetch_sdui_weeks(weeks)
+                except Exception as retry_error: e = retry_error  # report why the retry failed, not the stale 401
         log_msg(f"Network Error: {e}")
         return None
     except Exception as e:
         log_msg(f"Error: {e}")
         return None
 
+# Event colors (Google Calendar colorId)
+COLOR_EXAM = '11'
+COLOR_HOLIDAY = '10'
+COLOR_CHANGE = '6'
+COLOR_EVENT = '3'
+COLOR_CANCELLED = '8'
+COLOR_DEFAULT = '9'
+
+# oftype -> (summary prefix, colorId)
+OFTYPE_TABLE = {
+    "CANCLED": ("❌ Cancelled: ", COLOR_CANCELLED),
+    "BOOKABLE_CHANGE": ("⚠️ Room: ", COLOR_CHANGE),
+    "SUBSTITUTION": ("🔄 Sub: ", COLOR_CHANGE),
+    "EXAM": ("📝 Exam: ", COLOR_EXAM),
+}
+OFTYPE_DEFAULT = ("", COLOR_DEFAULT)
+
 def process_sdui_data(sdui_data):
     events = []
     if not sdui_data or 'data' not in sdui_data: return events
     lessons = sdui_data.get('data', {}).get('lessons', [])
-    tz = pytz.timezone(TIMEZONE)
-    
-    oftype_map = {"CANCLED": "❌ Cancelled: ", "BOOKABLE_CHANGE": "⚠️ Room: ", "SUBSTITUTION": "🔄 Sub: ", "EXAM": "📝 Exam: "}
-    COLOR_EXAM = '11'
-    COLOR_HOLIDAY = '10'
-    COLOR_CHANGE = '6'
-    COLOR_EVENT = '3'
-    COLOR_DEFAULT = '9'
+    tz = TZ
+    # Local bindings skip global/attribute lookups in the per-lesson loop
+    fromts = datetime.fromtimestamp
+    append = events.append
 
     for lesson in lessons:
-        kind = lesson.get('kind')
-        oftype = lesson.get('oftype')
-        color_id = COLOR_DEFAULT
+        get = lesson.get
+        ts_start, ts_end = get('begins_at'), get('ends_at')
+        if not ts_start or not ts_end: continue
 
-        if kind in ['HOLIDAY', 'EVENT']:
-            meta = lesson.get('meta') or {}
-            subject = meta.get('displayname') or lesson.get('comment') or "Event"
+        kind = get('kind')
+        oftype = get('oftype')
+
+        if kind in ('HOLIDAY', 'EVENT'):
+            meta = get('meta') or {}
+            subject = meta.get('displayname') or get('comment') or "Event"
             summary = f"🏖️ {subject}" if kind == 'HOLIDAY' else f"📅 {subject}"
             color_id = COLOR_HOLIDAY if kind == 'HOLIDAY' else COLOR_EVENT
-            description = f"Type: {kind}\nComment: {lesson.get('comment', '')}"
+            description = f"Type: {kind}\nComment: {get('comment', '')}"
             location = ""
         else:
-            course = lesson.get('course') or {}
-            subject = (course.get('meta') or {}).get('displayname', 'Unknown').split('_')[-1]
-            summary = f"{oftype_map.get(oftype, '')}{subject}"
-            
-            if oftype == 'EXAM': color_id = COLOR_EXAM
-            elif oftype in ['SUBSTITUTION', 'BOOKABLE_CHANGE']: color_id = COLOR_CHANGE
-            elif oftype == 'CANCLED': color_id = '8'
-            
-            rooms = [b['name'] for b in (lesson.get('bookables') or []) if 'name' in b]
-            teachers = [t['name'] for t in (lesson.get('teachers') or []) if 'name' in t]
+            course = get('course') or {}
+            # Course names look like '10a_Mathe'; keep the part after the last underscore
+            subject = (course.get('meta') or {}).get('displayname', 'Unknown').rpartition('_')[2]
+            prefix, color_id = OFTYPE_TABLE.get(oftype, OFTYPE_DEFAULT)
+            summary = prefix + subject
+
+            rooms = [name for b in (get('bookables') or ()) if (name := b.get('name'))]
+            teachers = [name for t in (get('teachers') or ()) if (name := t.get('name'))]
             location = ", ".join(rooms)
             description = f"Teacher: {', '.join(teachers)}\nType: {kind or oftype}"
 
-        ts_start, ts_end = lesson.get('begins_at'), lesson.get('ends_at')
-        if not ts_start or not ts_end: continue
-        
-        events.append({
+        start_dt, end_dt = fromts(ts_start, tz), fromts(ts_end, tz)
+        append({
             'summary': summary,
-            'start': datetime.fromtimestamp(ts_start, tz).isoformat(),
-            'end': datetime.fromtimestamp(ts_end, tz).isoformat(),
+            'start': start_dt.isoformat(timespec='seconds'),
+            'end': end_dt.isoformat(timespec='seconds'),
+            'start_dt': start_dt,  # aware datetimes, kept so dedup doesn't re-parse the strings
+            'end_dt': end_dt,
             'location': location,
             'description': description,
             'colorId': color_id
         })
     return events
 
+# --- BATCHING ---
+BATCH_SIZE = 50  # Google Calendar's documented per-batch limit
+MAX_RETRIES = 8
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+def is_retryable(e):
+    """Rate limits and transient server errors. A 403 is only retried when it is a quota error."""
+    if not isinstance(e, HttpError): return False
+    if e.resp.status == 403: return 'usageLimits' in str(e)
+    return e.resp.status in RETRYABLE_STATUS
+
+def backoff_delay(attempt, e=None):
+    """Capped exponential backoff, stretched to the server's Retry-After when given."""
+    wait = min(60, (2 ** attempt) + random.random())
+    retry_after = e.resp.get('retry-after') if e is not None else None
+    if retry_after and retry_after.isdigit(): wait = max(wait, int(retry_after))
+    return wait
+
+def execute_with_retry(request):
+    """Executes a single API request, retrying retryable errors with backoff."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return request.execute()
+        except HttpError as e:
+            if not is_retryable(e) or attempt == MAX_RETRIES - 1: raise
+            wait = backoff_delay(attempt, e)
+            log_msg(f"API Error {e.resp.status}. Retrying in {wait:.1f}s...")
+            time.sleep(wait)
+
+def run_batched(service, items, build_request, on_success, on_error, abort):
+    """Executes one API call per item, packed into batch requests of BATCH_SIZE.
+    Retryable failures are re-queued and retried with exponential backoff until abort is set."""
+    pending = list(range(len(items)))
+
+    for attempt in range(MAX_RETRIES):
+        retry = []  # (index, HttpError)
+
+        def on_done(request_id, response, exception):
+            i = int(request_id)
+            if exception is None: on_success(i, response)
+            elif is_retryable(exception): retry.append((i, exception))
+            else: on_error(i, exception)
+
+        for offset in range(0, len(pending), BATCH_SIZE):
+            if abort.is_set(): return
+            chunk = pending[offset:offset + BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=on_done)
+            for i in chunk:
+                batch.add(build_request(items[i]), request_id=str(i))
+            try:
+                batch.execute()
+            except HttpError as e:
+                if is_retryable(e): retry.extend((i, e) for i in chunk)
+                else: log_msg(f"Batch Error: {e}")
+
+        pending = [i for i, _ in retry]
+        if not pending or abort.is_set(): return
+        if attempt == MAX_RETRIES - 1: break
+        wait = max(backoff_delay(attempt, e) for _, e in retry)
+        log_msg(f"Rate Limit Hit! Pausing {wait:.1f}s ({len(pending)} queued)...")
+        if abort.wait(wait): return  # /stop interrupts the backoff
+
+    log_msg(f"Gave up on {len(pending)} items after {MAX_RETRIES} attempts.")
+
+# --- DEDUPLICATION ---
+def event_key(summary, start, end):
+    """Identity of a Google event for duplicate detection, matching (summary, start_dt, end_dt)
+    of processed SDUI events; times compare by instant, not by offset text."""
+    return (summary, datetime.fromisoformat(start), datetime.fromisoformat(end))
+
+def existing_event_keys(service, cal_id, start, end):
+    """Returns the keys of all timed events already in the calendar between two dates."""
+    time_min = datetime.combine(start, datetime.min.time(), tzinfo=TZ).isoformat()
+    time_max = datetime.combine(end, datetime.max.time(), tzinfo=TZ).isoformat()
+    keys = set()
+    page_token = None
+    while True:
+        result = execute_with_retry(service.events().list(
+            calendarId=cal_id, timeMin=time_min, timeMax=time_max,
+            singleEvents=True, maxResults=2500, pageToken=page_token,
+            fields='nextPageToken,items(summary,start/dateTime,end/dateTime)'
+        ))
+        for item in result.get('items', []):
+            item_start = (item.get('start') or {}).get('dateTime')
+            item_end = (item.get('end') or {}).get('dateTime')
+            if item_start and item_end:
+                keys.add(event_key(item.get('summary', ''), item_start, item_end))
+        page_token = result.get('nextPageToken')
+        if not page_token: return keys
+
 # --- WORKERS ---
-def worker_sync(start, end):
-    global IS_RUNNING, ABORT_FLAG
-    IS_RUNNING = True
-    ABORT_FLAG = False
-    
+def worker_sync(cal_id, abort, start, end):
     log_msg("--- STARTING SYNC (Background) ---")
     data = get_sdui_data(start, end)
     
     if not data:
         log_msg("Data fetch failed.")
-        IS_RUNNING = False
         return
 
     events = process_sdui_data(data)
     if not events:
         log_msg("No events found.")
-        IS_RUNNING = False
         return
 
     service = get_calendar_service()
     if not service:
         log_msg("Google Auth failed.")
-        IS_RUNNING = False
+        return
+
+    try:
+        existing = existing_event_keys(service, cal_id, start, end)
+    except HttpError as e:
+        log_msg(f"Duplicate check failed, uploading all events: {e}")
+        existing = set()
+
+    new_events = [e for e in events if (e['summary'], e['start_dt'], e['end_dt']) not in existing]
+    if len(new_events) < len(events):
+        log_msg(f"Skipping {len(events) - len(new_events)} events already in the calendar.")
+    events = new_events
+    if not events:
+        log_msg("--- FINISHED. Calendar already up to date. ---")
         return
 
     count = 0
     total = len(events)
     log_msg(f"Queue: {total} events.")
 
-    for i, event in enumerate(events):
-        if ABORT_FLAG:
-            log_msg("!!! STOPPED BY USER !!!")
-            break
-
+    def build_insert(event):
         body = {
             'summary': event['summary'],
             'location': event['location'],
@@ -349,78 +605,96 @@ def worker_sync(start, end):
             'end': {'dateTime': event['end'], 'timeZone': TIMEZONE},
             'colorId': event['colorId']
         }
+        return service.events().insert(calendarId=cal_id, body=body)
 
-        max_retries = 8
-        for attempt in range(max_retries):
-            if ABORT_FLAG: break
-            try:
-                service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=body).execute()
-                count += 1
-                log_msg(f"[{i+1}/{total}] Uploaded: {event['summary']}")
-                break 
-            except HttpError as e:
-                if e.resp.status == 403 and 'usageLimits' in str(e):
-                    wait = (2 ** attempt) + random.random()
-                    log_msg(f"Rate Limit Hit! Pausing {wait:.1f}s...")
-                    time.sleep(wait)
-                else:
-                    log_msg(f"Error on item {i}: {e}")
-                    break 
+    def on_uploaded(i, response):
+        nonlocal count
+        count += 1
+        log_msg(f"[{i+1}/{total}] Uploaded: {events[i]['summary']}")
+
+    def on_failed(i, e):
+        log_msg(f"Error on item {i}: {e}")
+
+    run_batched(service, events, build_insert, on_uploaded, on_failed, abort)
+    if abort.is_set(): log_msg("!!! STOPPED BY USER !!!")
 
     log_msg(f"--- FINISHED. Imported {count} events. ---")
-    IS_RUNNING = False
 
-def worker_clear(start, end):
-    global IS_RUNNING, ABORT_FLAG
-    IS_RUNNING = True
-    ABORT_FLAG = False
-    
+def worker_clear(cal_id, abort, start, end):
     log_msg("--- STARTING DELETE (Background) ---")
     service = get_calendar_service()
-    tz = pytz.timezone(TIMEZONE)
-    start_dt = tz.localize(datetime.combine(start, datetime.min.time()))
-    end_dt = tz.localize(datetime.combine(end, datetime.max.time()))
-    
-    total_deleted = 0
-    
-    for pass_num in range(1, 6):
-        if ABORT_FLAG: break
-        log_msg(f"Pass {pass_num}: Scanning for events...")
-        
+    if not service:
+        log_msg("Google Auth failed.")
+        return
+    start_dt = datetime.combine(start, datetime.min.time(), tzinfo=TZ)
+    end_dt = datetime.combine(end, datetime.max.time(), tzinfo=TZ)
+
+    log_msg("Scanning for events...")
+    events = []
+    page_token = None
+    while True:
+        if abort.is_set(): break
         try:
-            events_result = service.events().list(
-                calendarId=GOOGLE_CALENDAR_ID, timeMin=start_dt.isoformat(),
-                timeMax=end_dt.isoformat(), singleEvents=True, maxResults=250
-            ).execute()
-        except: break
-        
-        events = events_result.get('items', [])
-        if not events:
-            log_msg("Clean.")
-            break
-            
+            events_result = execute_with_retry(service.events().list(
+                calendarId=cal_id, timeMin=start_dt.isoformat(),
+                timeMax=end_dt.isoformat(), singleEvents=True, maxResults=2500,
+                showDeleted=False, pageToken=page_token, fields='nextPageToken,items/id'
+            ))
+        except HttpError as e:
+            log_msg(f"List Error: {e}")
+            return
+        events.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+        if not page_token: break
+
+    total_deleted = 0
+    if events and not abort.is_set():
         log_msg(f"Found {len(events)} events to delete.")
-        batch_del = 0
-        
-        for event in events:
-            if ABORT_FLAG: break
-            try:
-                service.events().delete(calendarId=GOOGLE_CALENDAR_ID, eventId=event['id']).execute()
-                batch_del += 1
-                total_deleted += 1
-                if total_deleted % 10 == 0: log_msg(f"Deleted {total_deleted}...")
-            except HttpError as e:
-                if e.resp.status == 403:
-                    log_msg("Rate Limit (Delete). Waiting 2s...")
-                    time.sleep(2)
-                elif '404' not in str(e) and '410' not in str(e):
-                    log_msg(f"Del Error: {e}")
 
-        if batch_del == 0: break
-    
-    if ABORT_FLAG: log_msg("!!! STOPPED BY USER !!!")
+        def build_delete(event):
+            return service.events().delete(calendarId=cal_id, eventId=event['id'])
+
+        def on_deleted(i, response):
+            nonlocal total_deleted
+            total_deleted += 1
+            if total_deleted % 10 == 0: log_msg(f"Deleted {total_deleted}...")
+
+        def on_failed(i, e):
+            if e.resp.status not in (404, 410):
+                log_msg(f"Del Error: {e}")
+
+        run_batched(service, events, build_delete, on_deleted, on_failed, abort)
+    elif not events:
+        log_msg("Clean.")
+
+    if abort.is_set(): log_msg("!!! STOPPED BY USER !!!")
     else: log_msg(f"--- FINISHED. Deleted {total_deleted} events. ---")
-    IS_RUNNING = False
+
+def is_running(cal_id=None):
+    """True if a job holds the lock for cal_id, or for any calendar when cal_id is None."""
+    if cal_id is None: return any(lock.locked() for lock in list(_JOB_LOCKS.values()))
+    lock = _JOB_LOCKS.get(cal_id)
+    return bool(lock and lock.locked())
+
+def start_job(target, start, end):
+    """Runs a worker against the configured calendar on a daemon thread so the request returns immediately.
+    Jobs on the same calendar are serialized; returns False if one is already running."""
+    cal_id = GOOGLE_CALENDAR_ID
+    lock = _JOB_LOCKS.setdefault(cal_id, threading.Lock())
+    if not lock.acquire(blocking=False): return False
+    abort = _ABORT_EVENTS.setdefault(cal_id, threading.Event())
+    abort.clear()
+
+    def run():
+        try:
+            target(cal_id, abort, start, end)
+        except Exception as e:
+            log_msg(f"Worker crashed: {e}")
+        finally:
+            lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
 
 # --- ROUTES ---
 @app.route('/')
@@ -465,20 +739,46 @@ def update_settings():
 
 @app.route('/logs')
 def stream_logs():
-    return jsonify({'logs': LOG_BUFFER, 'running': IS_RUNNING})
+    since = request.args.get('since', 0, type=int)
+    with LOG_COND: snapshot, seq_now = list(LOG_BUFFER), LOG_SEQ  # workers append under LOG_COND
+    logs = [entry for seq, entry in snapshot if seq > since]
+    return jsonify({'logs': logs, 'seq': seq_now, 'running': is_running()})
+
+@app.route('/logs/stream')
+def stream_logs_sse():
+    """Pushes new log entries as Server-Sent Events instead of re-sending the buffer."""
+    last_seen = request.headers.get('Last-Event-ID', 0, type=int)
+
+    def generate(last_seq):
+        if last_seq > LOG_SEQ: last_seq = 0  # client saw a previous server run
+        while True:
+            with LOG_COND:
+                LOG_COND.wait_for(lambda: LOG_SEQ > last_seq, timeout=15)
+                new = [(seq, entry) for seq, entry in LOG_BUFFER if seq > last_seq]
+            if not new:
+                yield ": keep-alive\n\n"
+                continue
+            for seq, entry in new:
+                data = entry.replace('\n', '\ndata: ')
+                yield f"id: {seq}\ndata: {data}\n\n"
+            last_seq = new[-1][0]
+
+    return Response(generate(last_seen), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 @app.route('/stop', methods=['POST'])
 def stop_process():
-    global ABORT_FLAG
-    if IS_RUNNING:
-        ABORT_FLAG = True
+    # Stop every running job, matching what /logs reports as running (the calendar id may have changed)
+    running = [cal_id for cal_id, lock in list(_JOB_LOCKS.items()) if lock.locked()]
+    if running:
+        for cal_id in running: _ABORT_EVENTS[cal_id].set()
         log_msg(">>> STOP SIGNAL RECEIVED <<<")
         return jsonify({'status': 'stopping'})
     return jsonify({'status': 'not_running'})
 
 @app.route('/clear_logs', methods=['POST'])
 def clear_logs_route():
-    LOG_BUFFER.clear()
+    with LOG_COND: LOG_BUFFER.clear()
     return jsonify({"status": "cleared"})
 
 @app.route('/set_year', methods=['POST'])
@@ -489,64 +789,50 @@ def set_year():
     except: flash("Invalid Year", "danger")
     return redirect(url_for('index'))
 
+def form_week_range():
+    """Parses the posted ISO week range in the session's year into (start_w, end_w, start, end)."""
+    year = int(session.get('year', datetime.now().year))
+    start_w = int(request.form['start_week'])
+    end_w = int(request.form.get('end_week') or start_w)
+    if start_w > end_w: raise ValueError("Invalid Range")
+
+    start = datetime.fromisocalendar(year, start_w, 1).date()
+    end = datetime.fromisocalendar(year, end_w, 7).date()
+    return start_w, end_w, start, end
+
+def launch(target, start, end, message):
+    if start_job(target, start, end): flash(message, "info")
+    else: flash("Process already running!", "danger")
+
 @app.route('/sync/today')
 def sync_today():
-    if IS_RUNNING:
-        flash("Process already running!", "danger")
-        return redirect(url_for('index'))
-    tz = pytz.timezone(TIMEZONE)
-    today = datetime.now(tz).date()
-    threading.Thread(target=worker_sync, args=(today, today)).start()
-    flash("Started Sync (Check Terminal)", "info")
+    today = datetime.now(TZ).date()
+    launch(worker_sync, today, today, "Started Sync (Check Terminal)")
     return redirect(url_for('index'))
 
 @app.route('/sync/week', methods=['POST'])
 def sync_week():
-    if IS_RUNNING:
-        flash("Process already running!", "danger")
-        return redirect(url_for('index'))
     try:
-        year = int(session.get('year', datetime.now().year))
-        start_w = int(request.form['start_week'])
-        end_w = int(request.form.get('end_week') or start_w)
-        if start_w > end_w: raise ValueError("Invalid Range")
-        
-        start = datetime.fromisocalendar(year, start_w, 1).date()
-        end = datetime.fromisocalendar(year, end_w, 7).date()
-        
-        threading.Thread(target=worker_sync, args=(start, end)).start()
-        flash(f"Started Sync: Week {start_w}-{end_w}", "info")
+        start_w, end_w, start, end = form_week_range()
+        launch(worker_sync, start, end, f"Started Sync: Week {start_w}-{end_w}")
     except: flash("Input Error", "danger")
     return redirect(url_for('index'))
 
 @app.route('/sync/custom', methods=['POST'])
 def sync_custom():
-    if IS_RUNNING:
-        flash("Process already running!", "danger")
-        return redirect(url_for('index'))
     try:
         start = datetime.strptime(request.form['start'], "%Y-%m-%d").date()
         end = datetime.strptime(request.form['end'], "%Y-%m-%d").date()
-        threading.Thread(target=worker_sync, args=(start, end)).start()
-        flash("Started Custom Sync", "info")
+        if start > end: raise ValueError("Invalid Range")
+        launch(worker_sync, start, end, "Started Custom Sync")
     except: flash("Input Error", "danger")
     return redirect(url_for('index'))
 
 @app.route('/clear/weeks', methods=['POST'])
 def clear_weeks():
-    if IS_RUNNING:
-        flash("Process already running!", "danger")
-        return redirect(url_for('index'))
     try:
-        year = int(session.get('year', datetime.now().year))
-        start_w = int(request.form['start_week'])
-        end_w = int(request.form.get('end_week') or start_w)
-        
-        start = datetime.fromisocalendar(year, start_w, 1).date()
-        end = datetime.fromisocalendar(year, end_w, 7).date()
-        
-        threading.Thread(target=worker_clear, args=(start, end)).start()
-        flash("Started Deletion Process", "info")
+        _, _, start, end = form_week_range()
+        launch(worker_clear, start, end, "Started Deletion Process")
     except: flash("Input Error", "danger")
     return redirect(url_for('index'))
 